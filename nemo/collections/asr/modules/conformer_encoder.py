@@ -118,6 +118,12 @@ class ConformerEncoder(NeuralModule, StreamingEncoder, Exportable, AccessMixin):
             All layers before this will never be dropped. Note that drop
             probability will be adjusted accordingly if mode is "linear" when
             start layer is > 1. Defaults to 1.
+        use_fused_attention (bool): whether the local attention of 'rel_pos_local_attn' uses the fused scaled dot
+            product attention kernel when it is available, instead of the banded chunked implementation.
+            Defaults to True.
+        use_torch_compile (bool): whether to compile the attention layers with torch.compile when it is available.
+            Compiled models can not be exported.
+            Defaults to False.
     """
 
     def input_example(self, max_batch=1, max_dim=256):
@@ -233,6 +239,8 @@ class ConformerEncoder(NeuralModule, StreamingEncoder, Exportable, AccessMixin):
         stochastic_depth_drop_prob: float = 0.0,
         stochastic_depth_mode: str = "linear",
         stochastic_depth_start_layer: int = 1,
+        use_fused_attention: bool = True,
+        use_torch_compile: bool = False,
     ):
         super().__init__()
         d_ff = d_model * ff_expansion_factor
@@ -243,6 +251,8 @@ class ConformerEncoder(NeuralModule, StreamingEncoder, Exportable, AccessMixin):
         self.att_context_style = att_context_style
         self.subsampling_factor = subsampling_factor
         self.self_attention_model = self_attention_model
+        self.use_fused_attention = use_fused_attention
+        self.use_torch_compile = use_torch_compile
 
         if att_context_size:
             self.att_context_size = list(att_context_size)
@@ -388,6 +398,8 @@ class ConformerEncoder(NeuralModule, StreamingEncoder, Exportable, AccessMixin):
                 pos_bias_u=pos_bias_u,
                 pos_bias_v=pos_bias_v,
                 att_context_size=self.att_context_size,
+                use_fused_attention=use_fused_attention,
+                use_torch_compile=use_torch_compile,
             )
             self.layers.append(layer)
 
@@ -893,6 +905,7 @@ class ConformerEncoder(NeuralModule, StreamingEncoder, Exportable, AccessMixin):
                         max_cache_len=att_context_size[0],
                         pos_bias_u=None,
                         pos_bias_v=None,
+                        use_torch_compile=self.use_torch_compile,
                     )
                 elif self_attention_model == 'rel_pos_local_attn':
                     new_attn = RelPositionMultiHeadAttentionLongformer(
@@ -903,6 +916,8 @@ class ConformerEncoder(NeuralModule, StreamingEncoder, Exportable, AccessMixin):
                         att_context_size=att_context_size,
                         pos_bias_u=None,
                         pos_bias_v=None,
+                        use_fused_attention=self.use_fused_attention,
+                        use_torch_compile=self.use_torch_compile,
                     )
                 elif self_attention_model == 'abs_pos':
                     new_attn = MultiHeadAttention(
@@ -910,6 +925,7 @@ class ConformerEncoder(NeuralModule, StreamingEncoder, Exportable, AccessMixin):
                         n_feat=self._cfg.d_model,
                         dropout_rate=self._cfg.dropout_att,
                         max_cache_len=att_context_size[0],
+                        use_torch_compile=self.use_torch_compile,
                     )
                 else:
                     raise ValueError(
@@ -84,6 +84,9 @@ class SqueezeformerEncoder(NeuralModule, Exportable, AccessMixin):
         time_recovery_idx (int): Optional integer index of a layer where the time recovery operation will occur.
             All operations beyond this point will occur at the original resolution (resolution after
             primary downsampling). If no value is provided, assumed to be the last layer.
+        use_torch_compile (bool): whether to compile the attention layers with torch.compile when it is available.
+            Compiled models can not be exported.
+            Defaults to False.
     """
 
     def input_example(self, max_batch=1, max_dim=256):
@@ -143,6 +146,7 @@ class SqueezeformerEncoder(NeuralModule, Exportable, AccessMixin):
         adaptive_scale: bool = True,
         time_reduce_idx: Optional[int] = None,
         time_recovery_idx: Optional[int] = None,
+        use_torch_compile: bool = False,
     ):
         super().__init__()
 
@@ -239,6 +243,7 @@ class SqueezeformerEncoder(NeuralModule, Exportable, AccessMixin):
                 pos_bias_u=pos_bias_u,
                 pos_bias_v=pos_bias_v,
                 adaptive_scale=adaptive_scale,
+                use_torch_compile=use_torch_compile,
             )
             self.layers.append(layer)
 
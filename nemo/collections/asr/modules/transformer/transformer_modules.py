@@ -48,12 +48,11 @@ class FixedPositionalEncoding(nn.Module):
         """
         Builds/replaces pre-computed positional encoding.
         """
-        pos_enc = torch.zeros(max_sequence_length, hidden_size, device=device)
-        position = torch.arange(0.0, max_sequence_length).unsqueeze(1)
+        position = torch.arange(0.0, max_sequence_length, device=device).unsqueeze(1)
         coef = -math.log(10000.0) / hidden_size
-        div_term = torch.exp(coef * torch.arange(0.0, hidden_size, 2))
-        pos_enc[:, 0::2] = torch.sin(position * div_term)
-        pos_enc[:, 1::2] = torch.cos(position * div_term)
+        div_term = torch.exp(coef * torch.arange(0.0, hidden_size, 2, device=device))
+        angles = position * div_term
+        pos_enc = torch.stack((torch.sin(angles), torch.cos(angles)), dim=-1).view(-1, hidden_size)
         pos_enc.div_(math.sqrt(hidden_size))
         self.register_buffer('pos_enc', pos_enc)
 
@@ -43,6 +43,9 @@ class ConformerLayer(torch.nn.Module, AdapterModuleMixin, AccessMixin):
         conv_kernel_size (int): kernel size for depthwise convolution in convolution module
         dropout (float): dropout probabilities for linear layers
         dropout_att (float): dropout probabilities for attention distributions
+        use_fused_attention (bool): whether the local attention uses the fused scaled dot product attention kernel
+            when it is available, only used by the 'rel_pos_local_attn' attention model
+        use_torch_compile (bool): whether to compile the attention layer with torch.compile when it is available
     """
 
     def __init__(
@@ -59,6 +62,8 @@ class ConformerLayer(torch.nn.Module, AdapterModuleMixin, AccessMixin):
         pos_bias_u=None,
         pos_bias_v=None,
         att_context_size=[-1, -1],
+        use_fused_attention=True,
+        use_torch_compile=False,
     ):
         super(ConformerLayer, self).__init__()
 
@@ -91,6 +96,7 @@ class ConformerLayer(torch.nn.Module, AdapterModuleMixin, AccessMixin):
                 pos_bias_u=pos_bias_u,
                 pos_bias_v=pos_bias_v,
                 max_cache_len=MHA_max_cache_len,
+                use_torch_compile=use_torch_compile,
             )
         elif self_attention_model == 'rel_pos_local_attn':
             self.self_attn = RelPositionMultiHeadAttentionLongformer(
@@ -101,10 +107,16 @@ class ConformerLayer(torch.nn.Module, AdapterModuleMixin, AccessMixin):
                 pos_bias_v=pos_bias_v,
                 max_cache_len=MHA_max_cache_len,
                 att_context_size=att_context_size,
+                use_fused_attention=use_fused_attention,
+                use_torch_compile=use_torch_compile,
             )
         elif self_attention_model == 'abs_pos':
             self.self_attn = MultiHeadAttention(
-                n_head=n_heads, n_feat=d_model, dropout_rate=dropout_att, max_cache_len=MHA_max_cache_len
+                n_head=n_heads,
+                n_feat=d_model,
+                dropout_rate=dropout_att,
+                max_cache_len=MHA_max_cache_len,
+                use_torch_compile=use_torch_compile,
             )
         else:
             raise ValueError(
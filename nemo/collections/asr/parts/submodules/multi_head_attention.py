@@ -33,6 +33,7 @@ Part of this code is adopted from https://github.com/espnet/espnet
 """
 
 import math
+from contextlib import nullcontext
 from functools import lru_cache
 from typing import List
 
@@ -48,6 +49,19 @@ __all__ = [
     'PositionalEncoding',
 ]
 
+# fused scaled dot product attention (FlashAttention / memory efficient kernels) is available from PyTorch 2.0
+HAVE_SDPA = hasattr(F, 'scaled_dot_product_attention')
+# in-place compilation of modules with torch.compile is available from PyTorch 2.2
+HAVE_MODULE_COMPILE = hasattr(nn.Module, 'compile')
+
+
+def _can_use_sdpa() -> bool:
+    """Whether the fused scaled dot product attention can be used by the current call.
+    The kernel can not be exported to ONNX by older PyTorch versions and needs opset 14 or newer,
+    so the explicit attention is exported instead.
+    """
+    return HAVE_SDPA and not torch.onnx.is_in_onnx_export()
+
 
 class MultiHeadAttention(nn.Module):
     """Multi-Head Attention layer of Transformer.
@@ -55,9 +69,13 @@ class MultiHeadAttention(nn.Module):
         n_head (int): number of heads
         n_feat (int): size of the features
         dropout_rate (float): dropout rate
+        max_cache_len (int): the maximum size of cache
+        use_torch_compile (bool): whether to compile the forward pass with torch.compile when it is available,
+            which fuses the chains of elementwise operations around the attention. Compiled modules can not be
+            exported, so it is disabled by default
     """
 
-    def __init__(self, n_head, n_feat, dropout_rate, max_cache_len=0):
+    def __init__(self, n_head, n_feat, dropout_rate, max_cache_len=0, use_torch_compile=False):
         """Construct an MultiHeadedAttention object."""
         super(MultiHeadAttention, self).__init__()
         self.cache_drop_size = None
@@ -74,6 +92,15 @@ class MultiHeadAttention(nn.Module):
 
         self._max_cache_len = max_cache_len
         self._cache_id = None
+        self.quantized_projections = False
+        self._packed_qkv = None
+        self._packed_qkv_version = None
+
+        self.use_torch_compile = use_torch_compile and HAVE_MODULE_COMPILE
+        if self.use_torch_compile:
+            # compiles lazily on the first call, the parameters and the state dict keys stay the same
+            # time dimensions change between batches, so the graph is compiled with dynamic shapes
+            self.compile(dynamic=True)
 
     def forward_qkv(self, query, key, value):
         """Transforms query, key and value.
@@ -87,15 +114,54 @@ class MultiHeadAttention(nn.Module):
             v (torch.Tensor): (batch, head, time2, size)
         """
         n_batch = query.size(0)
-        q = self.linear_q(query).view(n_batch, -1, self.h, self.d_k)
-        k = self.linear_k(key).view(n_batch, -1, self.h, self.d_k)
-        v = self.linear_v(value).view(n_batch, -1, self.h, self.d_k)
+        if query is key and key is value and not self.quantized_projections and not torch.jit.is_tracing():
+            # self-attention, the three projections are computed by a single GEMM with the packed weights
+            weight, bias = self._get_packed_qkv()
+            qkv = F.linear(query, weight, bias).view(n_batch, -1, 3, self.h, self.d_k)
+            q, k, v = qkv.unbind(dim=2)
+        else:
+            q = self.linear_q(query).view(n_batch, -1, self.h, self.d_k)
+            k = self.linear_k(key).view(n_batch, -1, self.h, self.d_k)
+            v = self.linear_v(value).view(n_batch, -1, self.h, self.d_k)
         q = q.transpose(1, 2)
         k = k.transpose(1, 2)
         v = v.transpose(1, 2)
 
         return q, k, v
 
+    def _get_packed_qkv(self):
+        """Returns the weight and the bias of the query, key and value projections packed for a single GEMM.
+        The projections stay separate parameters, so the optimizer states and the checkpoints are not affected.
+        When no gradients are needed, the packed tensors are cached until one of the projections changes.
+        """
+        params = [self.linear_q.weight, self.linear_k.weight, self.linear_v.weight]
+        params += [self.linear_q.bias, self.linear_k.bias, self.linear_v.bias]
+        if self.use_torch_compile or torch.is_grad_enabled():
+            # the gradients flow back to the separate projections, the compiler can not trace the cache lookup
+            return torch.cat(params[:3], dim=0), torch.cat(params[3:], dim=0)
+        # in-place updates bump the version counters, loading or moving the module replaces the storages
+        version = tuple((p.data_ptr(), p._version) for p in params)
+        if version != self._packed_qkv_version:
+            self._packed_qkv = (torch.cat(params[:3], dim=0), torch.cat(params[3:], dim=0))
+            self._packed_qkv_version = version
+        return self._packed_qkv
+
+    def quantize_projections(self):
+        """Replaces the query, key, value and output projections by dynamically quantized int8 linear layers.
+        The weights are stored in int8 with per-tensor scales, the activations are quantized on the fly and the
+        attention itself still runs in floating point. Quantized layers only support CPU inference.
+        """
+        if self.training:
+            raise RuntimeError("Projections can only be quantized for inference, call `eval()` first")
+        if self.quantized_projections:
+            return
+        for name in ['linear_q', 'linear_k', 'linear_v', 'linear_out']:
+            quantized = torch.ao.quantization.quantize_dynamic(
+                nn.Sequential(getattr(self, name)), {nn.Linear}, dtype=torch.qint8
+            )
+            setattr(self, name, quantized[0])
+        self.quantized_projections = True
+
     def forward_attention(self, value, scores, mask):
         """Compute attention context vector.
         Args:
@@ -109,12 +175,47 @@ class MultiHeadAttention(nn.Module):
         if mask is not None:
             mask = mask.unsqueeze(1)  # (batch, 1, time1, time2)
             scores = scores.masked_fill(mask, -10000.0)
-            attn = torch.softmax(scores, dim=-1).masked_fill(mask, 0.0)  # (batch, head, time1, time2)
-        else:
-            attn = torch.softmax(scores, dim=-1)  # (batch, head, time1, time2)
+        attn = torch.softmax(scores, dim=-1)  # (batch, head, time1, time2)
 
         p_attn = self.dropout(attn)
         x = torch.matmul(p_attn, value)  # (batch, head, time1, d_k)
+        if mask is not None:
+            # masked positions already get zero weights after the softmax, only the outputs of fully masked rows
+            # need to be zeroed, which is much cheaper than masking the whole attention matrix again
+            x = x.masked_fill(mask.all(dim=-1, keepdim=True), 0.0)
+        x = x.transpose(1, 2).reshape(n_batch, -1, self.h * self.d_k)  # (batch, time1, d_model)
+
+        return self.linear_out(x)  # (batch, time1, d_model)
+
+    def forward_fused_attention(self, q, k, v, mask, attn_bias=None):
+        """Compute attention context vector with the fused scaled dot product attention kernel.
+        The softmax runs inside the kernel, so the whole computation can run in half precision. The additive mask
+        (batch, 1, time1, time2), or the given bias (batch, head, time1, time2), is still materialized.
+        Args:
+            q (torch.Tensor): (batch, head, time1, d_k)
+            k (torch.Tensor): (batch, head, time2, d_k)
+            v (torch.Tensor): (batch, head, time2, d_k)
+            mask (torch.Tensor): (batch, time1, time2)
+            attn_bias (torch.Tensor): optional additive bias of the scaled scores (batch, head, time1, time2)
+        returns:
+            value (torch.Tensor): transformed `value` (batch, time1, d_model) weighted by the attention scores
+        """
+        n_batch = v.size(0)
+        attn_mask = attn_bias
+        if mask is not None:
+            mask = mask.unsqueeze(1)  # (batch, 1, time1, time2)
+            # additive mask instead of a boolean one, fully masked rows would produce NaNs otherwise
+            if attn_mask is None:
+                attn_mask = torch.zeros(mask.size(), dtype=q.dtype, device=q.device)
+            attn_mask = attn_mask.masked_fill(mask, -10000.0)
+
+        dropout_p = self.dropout.p if self.training else 0.0
+        # the default scale of the kernel is 1 / sqrt(d_k)
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+        # (batch, head, time1, d_k)
+        if mask is not None:
+            # zero the outputs of fully masked rows the same way as in forward_attention
+            x = x.masked_fill(mask.all(dim=-1, keepdim=True), 0.0)
         x = x.transpose(1, 2).reshape(n_batch, -1, self.h * self.d_k)  # (batch, time1, d_model)
 
         return self.linear_out(x)  # (batch, time1, d_model)
@@ -134,6 +235,10 @@ class MultiHeadAttention(nn.Module):
         """
         key, value, query = self.update_cache(key=key, value=value, query=query, cache=cache, cache_next=cache_next)
 
+        if _can_use_sdpa():
+            q, k, v = self.forward_qkv(query, key, value)
+            return self.forward_fused_attention(q, k, v, mask)
+
         if torch.is_autocast_enabled():
             query, key, value = query.to(torch.float32), key.to(torch.float32), value.to(torch.float32)
 
@@ -147,11 +252,18 @@ class MultiHeadAttention(nn.Module):
 
     def update_cache(self, key, value, query, cache, cache_next):
         if cache is not None:
+            is_self_attention = key is query
             key = value = torch.cat([cache[self._cache_id], key], dim=1)
             q_keep_size = query.shape[1] - self.cache_drop_size
             if cache_next is not None:
-                cache_next[self._cache_id, :, :-q_keep_size, :] = cache[self._cache_id, :, q_keep_size:, :]
-                cache_next[self._cache_id, :, -q_keep_size:, :] = query[:, :q_keep_size, :]
+                if is_self_attention:
+                    # the next cache is the old cache shifted by q_keep_size and followed by the first q_keep_size
+                    # frames of the query, which is a single slice of the already concatenated key
+                    cache_len = cache_next.size(2)
+                    cache_next[self._cache_id].copy_(key[:, q_keep_size : q_keep_size + cache_len])
+                else:
+                    cache_next[self._cache_id, :, :-q_keep_size, :] = cache[self._cache_id, :, q_keep_size:, :]
+                    cache_next[self._cache_id, :, -q_keep_size:, :] = query[:, :q_keep_size, :]
         return key, value, query
 
 
@@ -162,11 +274,21 @@ class RelPositionMultiHeadAttention(MultiHeadAttention):
         n_head (int): number of heads
         n_feat (int): size of the features
         dropout_rate (float): dropout rate
+        pos_bias_u (Tensor): the positional bias matrix U
+        pos_bias_v (Tensor): the positional bias matrix V
+        max_cache_len (int): the maximum size of cache
+        use_torch_compile (bool): whether to compile the forward pass with torch.compile when it is available
     """
 
-    def __init__(self, n_head, n_feat, dropout_rate, pos_bias_u, pos_bias_v, max_cache_len=0):
+    def __init__(self, n_head, n_feat, dropout_rate, pos_bias_u, pos_bias_v, max_cache_len=0, use_torch_compile=False):
         """Construct an RelPositionMultiHeadedAttention object."""
-        super().__init__(n_head=n_head, n_feat=n_feat, dropout_rate=dropout_rate, max_cache_len=max_cache_len)
+        super().__init__(
+            n_head=n_head,
+            n_feat=n_feat,
+            dropout_rate=dropout_rate,
+            max_cache_len=max_cache_len,
+            use_torch_compile=use_torch_compile,
+        )
         # linear transformation for positional encoding
         self.linear_pos = nn.Linear(n_feat, n_feat, bias=False)
         # these two learnable biases are used in matrix c and matrix d
@@ -182,14 +304,18 @@ class RelPositionMultiHeadAttention(MultiHeadAttention):
             self.pos_bias_u = pos_bias_u
             self.pos_bias_v = pos_bias_v
 
-    def rel_shift(self, x):
+    def rel_shift(self, x, padded=False):
         """Compute relative positional encoding.
         Args:
-            x (torch.Tensor): (batch, nheads, time, 2*time-1)
+            x (torch.Tensor): (batch, nheads, time, 2*time-1) or (batch, nheads, time, 2*time) if padded
+            padded (bool): whether x already has a column of zeros on the left side of last dimension
         """
-        b, h, qlen, pos_len = x.size()  # (b, h, t1, t2)
-        # need to add a column of zeros on the left side of last dimension to perform the relative shifting
-        x = torch.nn.functional.pad(x, pad=(1, 0))  # (b, h, t1, t2+1)
+        if not padded:
+            # need to add a column of zeros on the left side of last dimension to perform the relative shifting
+            x = torch.nn.functional.pad(x, pad=(1, 0))  # (b, h, t1, t2+1)
+        b, h, qlen, pos_len = x.size()  # (b, h, t1, t2+1)
+        pos_len -= 1
+        # only views from here on, no copy of x is made
         x = x.view(b, h, -1, qlen)  # (b, h, t2+1, t1)
         # need to drop the first row
         x = x[:, :, 1:].view(b, h, qlen, pos_len)  # (b, h, t1, t2)
@@ -210,39 +336,56 @@ class RelPositionMultiHeadAttention(MultiHeadAttention):
         """
         key, value, query = self.update_cache(key=key, value=value, query=query, cache=cache, cache_next=cache_next)
 
-        if torch.is_autocast_enabled():
-            query, key, value = query.to(torch.float32), key.to(torch.float32), value.to(torch.float32)
+        use_sdpa = _can_use_sdpa()
+        if use_sdpa:
+            # only the bias is materialized and the softmax runs inside the fused kernel,
+            # so the projections and matmuls can use half precision tensor cores under autocast
+            autocast_context = nullcontext()
+        else:
+            if torch.is_autocast_enabled():
+                query, key, value = query.to(torch.float32), key.to(torch.float32), value.to(torch.float32)
 
-        # temporary until we solve this more gracefully
-        with avoid_float16_autocast_context():
+            # temporary until we solve this more gracefully
+            autocast_context = avoid_float16_autocast_context()
+
+        with autocast_context:
             q, k, v = self.forward_qkv(query, key, value)
-            q = q.transpose(1, 2)  # (batch, time1, head, d_k)
 
             n_batch_pos = pos_emb.size(0)
             p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k)
             p = p.transpose(1, 2)  # (batch, head, time1, d_k)
-
-            # (batch, head, time1, d_k)
-            q_with_bias_u = (q + self.pos_bias_u).transpose(1, 2)
-            # (batch, head, time1, d_k)
-            q_with_bias_v = (q + self.pos_bias_v).transpose(1, 2)
-
-            # compute attention score
-            # first compute matrix a and matrix c
-            # as described in https://arxiv.org/abs/1901.02860 Section 3.3
-            # (batch, head, time1, time2)
-            matrix_ac = torch.matmul(q_with_bias_u, k.transpose(-2, -1))
+            # a leading zero position yields the zero column needed by rel_shift directly from the matmul,
+            # so the quadratic matrix_bd does not have to be padded and copied
+            p = F.pad(p, (0, 0, 1, 0))  # (batch, head, time1 + 1, d_k)
 
             # compute matrix b and matrix d
+            # as described in https://arxiv.org/abs/1901.02860 Section 3.3
+            # the scaling is applied to the query to avoid another pass over the quadratic tensor
+            # (batch, head, time1, d_k)
+            q_with_bias_v = (q + self.pos_bias_v.unsqueeze(1)) / self.s_d_k
             # (batch, head, time1, time2)
             matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
-            matrix_bd = self.rel_shift(matrix_bd)
+            matrix_bd = self.rel_shift(matrix_bd, padded=True)
             # drops extra elements in the matrix_bd to match the matrix_ac's size
-            matrix_bd = matrix_bd[:, :, :, : matrix_ac.size(-1)]
+            matrix_bd = matrix_bd[:, :, :, : k.size(-2)]
 
-            scores = (matrix_ac + matrix_bd) / self.s_d_k  # (batch, head, time1, time2)
+            # matrix c does not depend on the query, so it is computed once per key and broadcasted over time1
+            # instead of adding pos_bias_u to the whole query tensor
+            # (batch, head, 1, time2)
+            matrix_c = torch.einsum('hd,bhsd->bhs', self.pos_bias_u / self.s_d_k, k).unsqueeze(2)
 
-            out = self.forward_attention(v, scores, mask)
+            # scaled bias of the attention scores (batch, head, time1, time2)
+            attn_bias = matrix_bd + matrix_c
+
+            if use_sdpa:
+                # matrix a is computed inside the fused kernel
+                out = self.forward_fused_attention(q, k, v, mask, attn_bias=attn_bias)
+            else:
+                # compute matrix a and add the other terms
+                # (batch, head, time1, time2)
+                scores = torch.matmul(q / self.s_d_k, k.transpose(-2, -1)) + attn_bias
+
+                out = self.forward_attention(v, scores, mask)
 
         return out
 
@@ -259,9 +402,23 @@ class RelPositionMultiHeadAttentionLongformer(RelPositionMultiHeadAttention):
         pos_bias_v (Tensor): the positional bias matrix V
         att_context_size (List[int]): List of 2 ints corresponding to left and right attention context sizes.
         max_cache_len (int): the maximum size of cache
+        use_fused_attention (bool): whether to compute the local attention with the fused scaled dot product
+            attention kernel when it is available, instead of the banded chunked implementation
+        use_torch_compile (bool): whether to compile the forward pass with torch.compile when it is available
     """
 
-    def __init__(self, n_head, n_feat, dropout_rate, pos_bias_u, pos_bias_v, att_context_size, max_cache_len=0):
+    def __init__(
+        self,
+        n_head,
+        n_feat,
+        dropout_rate,
+        pos_bias_u,
+        pos_bias_v,
+        att_context_size,
+        max_cache_len=0,
+        use_fused_attention=True,
+        use_torch_compile=False,
+    ):
         """Construct an RelPositionMultiHeadedAttention object."""
         super().__init__(
             n_head=n_head,
@@ -270,8 +427,10 @@ class RelPositionMultiHeadAttentionLongformer(RelPositionMultiHeadAttention):
             pos_bias_u=pos_bias_u,
             pos_bias_v=pos_bias_v,
             max_cache_len=max_cache_len,
+            use_torch_compile=use_torch_compile,
         )
         self.att_context_size = att_context_size
+        self.use_fused_attention = use_fused_attention and HAVE_SDPA
 
     def forward(self, query, key, value, pad_mask, pos_emb, cache=None, cache_next=None):
         """Compute Scaled Dot Product Local Attention with rel. positional encoding. using overlapping chunks
@@ -289,11 +448,18 @@ class RelPositionMultiHeadAttentionLongformer(RelPositionMultiHeadAttention):
 
         key, value, query = self.update_cache(key=key, value=value, query=query, cache=cache, cache_next=cache_next)
 
-        if torch.is_autocast_enabled():
-            query, key, value = query.to(torch.float32), key.to(torch.float32), value.to(torch.float32)
+        use_fused_attention = self.use_fused_attention and _can_use_sdpa()
+        if use_fused_attention:
+            # the softmax runs inside the fused kernel, so half precision is safe under autocast
+            autocast_context = nullcontext()
+        else:
+            if torch.is_autocast_enabled():
+                query, key, value = query.to(torch.float32), key.to(torch.float32), value.to(torch.float32)
 
-        # temporary until we solve this more gracefully
-        with avoid_float16_autocast_context():
+            # temporary until we solve this more gracefully
+            autocast_context = avoid_float16_autocast_context()
+
+        with autocast_context:
             q, k, v = self.forward_qkv(query, key, value)
             n_batch, _, T, _ = q.size()
 
@@ -306,58 +472,133 @@ class RelPositionMultiHeadAttentionLongformer(RelPositionMultiHeadAttention):
             v = F.pad(v, (0, 0, 0, pad_len))  # (batch, head, time, size)
             mask = F.pad(pad_mask, (0, pad_len), value=1.0)
 
-            q_with_bias_u = q + self.pos_bias_u.unsqueeze(1)  # (batch, head, time, size)
-            q_with_bias_v = q + self.pos_bias_v.unsqueeze(1)  # (batch, head, time, size)
-
-            diagonal_matrix_ac = self.sliding_chunks_matmul_qk(
-                q_with_bias_u, k, w, padding_value=0.0
-            )  # (batch, head, time, 2w + 1)
-
             # add relative positional embedding
 
             n_batch_pos = pos_emb.size(0)
             p = self.linear_pos(pos_emb).view(n_batch_pos, -1, self.h, self.d_k).transpose(1, 2)
             # (batch, head, 2w, size)
-            diagonal_matrix_bd = torch.matmul(q_with_bias_v, p.transpose(-2, -1))
-            # (batch, head, time, 2w + 1)
-
-            start_pos = w - self.att_context_size[0]
-            end_pos = w + self.att_context_size[1]
-
-            diagonal_matrix_ac[:, :, :, : self.att_context_size[0]] += diagonal_matrix_bd[
-                :, :, :, : self.att_context_size[0]
-            ]
-            diagonal_matrix_ac[:, :, :, -(self.att_context_size[1] + 1) :] += diagonal_matrix_bd[
-                :, :, :, self.att_context_size[0] :
-            ]
-            scores = diagonal_matrix_ac / self.s_d_k
-            # (batch, head, time, 2w + 1)
 
-            # mask invalid positions
-            scores[:, :, :, :start_pos] = -10000.0
-            scores[:, :, :, end_pos + 1 :] = -10000.0
-
-            # This implementation is fast and takes very little memory because num_heads x hidden_size = 1
-            # from (bsz x seq_len) to (bsz x num_heads x seqlen x hidden_size)
-            mask = mask.unsqueeze(dim=1).unsqueeze(dim=-1)
-            # cast to float/half then replace 1's with -inf
-            float_mask = mask.type_as(scores).masked_fill(mask, -10000.0)
-            ones = float_mask.new_ones(size=float_mask.size())  # tensor of ones
-            # diagonal mask with zeros everywhere and -inf inplace of padding
-            d_mask = self.sliding_chunks_matmul_qk(ones, float_mask, w, padding_value=0.0)
+            # the positional biases are not added to the whole query tensor, their terms are computed separately
+            # pos_bias_v . p only depends on the position, so matrix d is a single row broadcasted over time
+            matrix_d = torch.einsum('hd,bhpd->bhp', self.pos_bias_v, p).unsqueeze(2)
+            diagonal_matrix_bd = torch.matmul(q, p.transpose(-2, -1)) + matrix_d
             # (batch, head, time, 2w + 1)
 
-            scores += d_mask
-
-            attn = torch.softmax(scores, dim=-1).masked_fill(mask, 0.0)
-            p_attn = self.dropout(attn)
+            # pos_bias_u . k only depends on the key, column j of query t takes the term of the key at t - w + j
+            matrix_c = torch.einsum('hd,bhtd->bht', self.pos_bias_u, k)
+            diagonal_matrix_c = self._sliding_windows(F.pad(matrix_c, (w, w)), dim=2, size=2 * w + 1, step=1)
             # (batch, head, time, 2w + 1)
 
-            x = self.sliding_chunks_matmul_pv(p_attn, v, w).reshape(n_batch, -1, self.h * self.d_k)[:, :T]
+            if use_fused_attention:
+                x = self.sliding_window_fused_attention(q, k, v, diagonal_matrix_c, diagonal_matrix_bd, mask, w)
+                # (batch, time, head, size)
+            else:
+                diagonal_matrix_ac = (
+                    self.sliding_chunks_matmul_qk(q, k, w, padding_value=0.0) + diagonal_matrix_c
+                )  # (batch, head, time, 2w + 1)
+
+                # column j corresponds to the key at time t - w + j, the positional scores cover the attention context
+                left_context, right_context = self.att_context_size
+                diagonal_matrix_ac[:, :, :, w - left_context : w + right_context + 1] += diagonal_matrix_bd
+
+                # This implementation is fast and takes very little memory because num_heads x hidden_size = 1
+                # from (bsz x seq_len) to (bsz x num_heads x seqlen x hidden_size)
+                mask = mask.unsqueeze(dim=1).unsqueeze(dim=-1)
+                # cast to float/half then replace 1's with -inf
+                float_mask = mask.type_as(diagonal_matrix_ac).masked_fill(mask, -10000.0)
+                ones = float_mask.new_ones(size=float_mask.size())  # tensor of ones
+                # diagonal mask with zeros everywhere and -inf inplace of padding
+                d_mask = self.sliding_chunks_matmul_qk(ones, float_mask, w, padding_value=0.0)
+                # (batch, 1, time, 2w + 1)
+
+                # mask positions outside of the attention context, the bias has no head dimension, so it is cheap
+                # to combine both masks before they are added to the scaled scores in a single pass
+                bias = d_mask + self._get_context_bias(
+                    w, self.att_context_size[0], self.att_context_size[1], d_mask.device, d_mask.dtype
+                )
+                scores = torch.add(bias, diagonal_matrix_ac, alpha=1 / self.s_d_k)
+                # (batch, head, time, 2w + 1)
+
+                attn = torch.softmax(scores, dim=-1).masked_fill(mask, 0.0)
+                p_attn = self.dropout(attn)
+                # (batch, head, time, 2w + 1)
+
+                x = self.sliding_chunks_matmul_pv(p_attn, v, w)
+                # (batch, time, head, size)
+
+            x = x.reshape(n_batch, -1, self.h * self.d_k)[:, :T]
             # (batch, time, size)
 
         return self.linear_out(x)
 
+    def sliding_window_fused_attention(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        c: torch.Tensor,
+        bd: torch.Tensor,
+        mask: torch.Tensor,
+        w: int,
+    ) -> torch.Tensor:
+        """Sliding window attention computed by the fused scaled dot product attention kernel.
+        Queries are split into non-overlapping chunks of size w, each attending to a window of 3w keys around it.
+        The positional scores and all masks are combined into one banded bias which is skewed to the window layout,
+        so neither the content scores nor the attention weights are materialized.
+
+        Args:
+            q (torch.Tensor): (batch, head, time, size)
+            k (torch.Tensor): (batch, head, time, size)
+            v (torch.Tensor): (batch, head, time, size)
+            c (torch.Tensor): (batch, head, time, 2w + 1) banded scores of the positional bias U
+            bd (torch.Tensor): (batch, head, time, left context + right context + 1) positional scores
+            mask (torch.Tensor): (batch, time) padding mask
+            w (int): Chunk overlap size
+
+        Returns:
+            output (torch.Tensor): (batch, time, head, size)
+        """
+        bsz, num_heads, seqlen, head_dim = q.size()
+        chunks_count = seqlen // w
+        left_context, right_context = self.att_context_size
+
+        # banded bias, column j corresponds to the key at time t - w + j
+        bias = c.clone()
+        bias[:, :, :, w - left_context : w + right_context + 1] += bd
+        bias /= self.s_d_k
+        # (batch, head, time, 2w + 1)
+
+        # mask positions outside of the attention context
+        bias[:, :, :, : w - left_context] = -10000.0
+        bias[:, :, :, w + right_context + 1 :] = -10000.0
+        # mask padded keys and keys outside of the sequence
+        key_mask = self._sliding_windows(F.pad(mask, (w, w), value=1.0), dim=1, size=2 * w + 1, step=1)
+        # (batch, time, 2w + 1)
+        bias.masked_fill_(key_mask.unsqueeze(1), -10000.0)
+
+        # move the band of each chunk of w queries to its window of 3w keys
+        bias = self._skew2(bias.view(bsz * num_heads, chunks_count, w, 2 * w + 1), padding_value=-10000.0)
+        bias = bias.reshape(bsz, num_heads * chunks_count, w, 3 * w)
+        # (batch, head x chunks_count, w, 3w)
+
+        q = q.reshape(bsz, num_heads * chunks_count, w, head_dim)
+        # windows of 3w keys and values starting w before each chunk of queries
+        k = self._sliding_windows(F.pad(k, (0, 0, w, w)), dim=2, size=3 * w, step=w)
+        k = k.reshape(bsz, num_heads * chunks_count, 3 * w, head_dim)
+        v = self._sliding_windows(F.pad(v, (0, 0, w, w)), dim=2, size=3 * w, step=w)
+        v = v.reshape(bsz, num_heads * chunks_count, 3 * w, head_dim)
+        # (batch, head x chunks_count, 3w, size)
+
+        dropout_p = self.dropout.p if self.training else 0.0
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=bias, dropout_p=dropout_p)
+        x = x.view(bsz, num_heads, seqlen, head_dim)
+        # (batch, head, time, size)
+
+        # zero the outputs of padded queries
+        x = x.masked_fill(mask.unsqueeze(1).unsqueeze(-1), 0.0)
+
+        return x.transpose(1, 2)
+
     # Longformer implementation for overlap case adapted for arbitrary left and right chunk size
     # https://github.com/allenai/longformer/blob/master/longformer/sliding_chunks.py
     def _skew(self, x: torch.Tensor, direction: List[int], padding_value: float) -> torch.Tensor:
@@ -395,6 +636,34 @@ class RelPositionMultiHeadAttentionLongformer(RelPositionMultiHeadAttention):
         x = x[:, :, :, :-1]
         return x
 
+    def _sliding_windows(self, x: torch.Tensor, dim: int, size: int, step: int) -> torch.Tensor:
+        """Overlapping windows of `size` elements taken every `step` elements along `dim`, without a copy.
+        Same as `x.unfold(dim, size, step).movedim(-1, dim + 1)`, but built with `as_strided`,
+        which unlike `unfold` can be exported to ONNX. During the export, the windows are gathered instead.
+
+        Args:
+            x (torch.Tensor): (..., time, ...)
+            dim (int): Dimension to take the windows along
+            size (int): Size of the windows
+            step (int): Step between the windows
+
+        Returns:
+            output (torch.Tensor): (..., windows_count, size, ...)
+        """
+        dim = dim % x.dim()
+        sizes = list(x.size())
+        strides = list(x.stride())
+        windows_count = (sizes[dim] - size) // step + 1
+        sizes[dim : dim + 1] = [windows_count, size]
+        if torch.onnx.is_in_onnx_export():
+            # the strides of `as_strided` are constants of the exported graph, which only fit the traced length,
+            # gathering the windows with computed indices keeps the time dimension dynamic
+            index = torch.arange(windows_count, device=x.device).unsqueeze(1) * step
+            index = index + torch.arange(size, device=x.device)
+            return x.index_select(dim, index.flatten()).view(sizes)
+        strides[dim : dim + 1] = [step * strides[dim], strides[dim]]
+        return x.as_strided(size=sizes, stride=strides)
+
     def _chunk_overlap(self, x: torch.Tensor, w: int) -> torch.Tensor:
         """Convert into overlapping chunks.
 
@@ -406,51 +675,59 @@ class RelPositionMultiHeadAttentionLongformer(RelPositionMultiHeadAttention):
             output (torch.Tensor): # (batch x head, chunk_count, 2w, size)
         """
 
-        # non-overlapping chunks of size = 2w
-        x = x.view(x.size(0), x.size(1) // (w * 2), w * 2, x.size(2))
+        # use `as_strided` to make chunks of size = 2w overlap with an overlap size = w
+        return self._sliding_windows(x, dim=1, size=2 * w, step=w)
 
-        # use `as_strided` to make the chunks overlap with an overlap size = w
-        chunk_size = list(x.size())
-        chunk_size[1] = chunk_size[1] * 2 - 1
+    @lru_cache()
+    def _get_context_bias(
+        self, w: int, left_context: int, right_context: int, device: torch.device, dtype: torch.dtype
+    ):
+        """Additive bias masking the locations outside of the attention context
+
+        Args:
+            w (int): Chunk overlap size
+            left_context (int): Left attention context size
+            right_context (int): Right attention context size
+            device (torch.device): Device of the bias
+            dtype (torch.dtype): Data type of the bias
 
-        chunk_stride = list(x.stride())
-        chunk_stride[1] = chunk_stride[1] // 2
-        return x.as_strided(size=chunk_size, stride=chunk_stride)
+        Returns:
+            output (torch.Tensor): (1, 1, 1, 2w + 1)
+        """
+        bias = torch.zeros(2 * w + 1, device=device, dtype=dtype)
+        bias[: w - left_context] = -10000.0
+        bias[w + right_context + 1 :] = -10000.0
+        return bias[None, None, None, :]
 
     @lru_cache()
-    def _get_invalid_locations_mask(self, w: int, device: str):
+    def _get_invalid_locations_mask(self, w: int, device: torch.device):
+        """Masks of the keys before the beginning and after the end of the sequence for the first and last w queries
 
-        diagonals_list = []
-        for j in range(-w, 1):
-            diagonal_mask = torch.zeros(w, device='cpu', dtype=torch.uint8)
-            diagonal_mask[:-j] = 1
-            diagonals_list.append(diagonal_mask)
+        Args:
+            w (int): Chunk overlap size
+            device (torch.device): Device of the masks
 
-        mask = torch.stack(diagonals_list, dim=-1)
+        Returns:
+            beginning_mask (torch.Tensor): (1, 1, w, w + 1)
+            ending_mask (torch.Tensor): (1, 1, w, w + 1)
+        """
+        # column j of the first w + 1 columns of query t corresponds to the key at time t - w + j
+        mask = torch.arange(w + 1, device=device) < (w - torch.arange(w, device=device)).unsqueeze(1)
         mask = mask[None, None, :, :]
+        return mask, mask.flip(dims=(2, 3))
 
-        ending_mask = mask.flip(dims=(2, 3)).bool().to(device)
-        return mask.bool().to(device), ending_mask
-
-    def mask_invalid_locations(
-        self, input_tensor: torch.Tensor, w: int,
-    ):
+    def mask_invalid_locations(self, input_tensor: torch.Tensor, w: int):
         """
         Mask locations invalid for the sliding window attention
 
         Args:
-            input_tensor (torch.Tensor): # (batch x head, time, size)
+            input_tensor (torch.Tensor): # (batch, head, time, 2w + 1)
             w (int): Chunk overlap size
         """
         beginning_mask, ending_mask = self._get_invalid_locations_mask(w, input_tensor.device)
-        seq_len = input_tensor.size(2)
-        beginning_input = input_tensor[:, :, :w, : w + 1]
-        beginning_mask = beginning_mask[:, :, :seq_len].expand(beginning_input.size())
-        beginning_input.masked_fill_(beginning_mask, -float('inf'))
-
-        ending_input = input_tensor[:, :, -w:, -(w + 1) :]
-        ending_mask = ending_mask[:, :, -seq_len:].expand(ending_input.size())
-        ending_input.masked_fill_(ending_mask, -float('inf'))
+        # only the first and the last w queries have keys outside of the sequence, the masks are broadcasted
+        input_tensor[:, :, :w, : w + 1].masked_fill_(beginning_mask, -float('inf'))
+        input_tensor[:, :, -w:, -(w + 1) :].masked_fill_(ending_mask, -float('inf'))
 
     def sliding_chunks_matmul_qk(self, q: torch.Tensor, k: torch.Tensor, w: int, padding_value: float) -> torch.Tensor:
         """Matrix multiplication of query x key tensors using with a sliding window attention pattern.
@@ -472,40 +749,43 @@ class RelPositionMultiHeadAttentionLongformer(RelPositionMultiHeadAttention):
 
         chunks_count = seqlen // w - 1
 
-        # group bsz and num_heads dimensions into one, then chunk seqlen into chunks of size w * 2
-        q = q.reshape(bsz * num_heads, seqlen, head_dim)
-        k = k.reshape(bsz * num_heads, seqlen, head_dim)
+        # group bsz and num_heads dimensions into one, then pad seqlen with w at the beginning and at the end
+        # with the extra chunks on both sides, every output chunk takes its lower triangle from the previous
+        # chunk and its upper triangle from the current one, the boundary chunks need no special handling
+        q = F.pad(q.reshape(bsz * num_heads, seqlen, head_dim), (0, 0, w, w))
+        k = F.pad(k.reshape(bsz * num_heads, seqlen, head_dim), (0, 0, w, w))
+        # (batch x head, time + 2w, size)
 
-        chunk_q = self._chunk_overlap(q, w)  # (batch x head, chunk_count, 2w, size)
-        chunk_k = self._chunk_overlap(k, w)  # (batch x head, chunk_count, 2w, size)
+        # chunk seqlen into chunks of size w * 2
+        chunk_q = self._chunk_overlap(q, w)  # (batch x head, chunk_count + 2, 2w, size)
+        chunk_k = self._chunk_overlap(k, w)  # (batch x head, chunk_count + 2, 2w, size)
 
         # matrix multipication
         # bcxd: bsz*num_heads x chunks x 2w x head_dim
         # bcyd: bsz*num_heads x chunks x 2w x head_dim
         # bcxy: bsz*num_heads x chunks x 2w x 2w
         chunk_attn = torch.einsum('bcxd,bcyd->bcxy', (chunk_q, chunk_k))  # multiply
-        # (batch x head, chunk_count, 2w, 2w)
+        # (batch x head, chunk_count + 2, 2w, 2w)
 
         # convert diagonals into columns
         diagonal_chunk_attn = self._skew(chunk_attn, direction=(0, 0, 0, 1), padding_value=padding_value)
-        # (batch x head, chunk_count, 2w, 2w + 1)
+        # (batch x head, chunk_count + 2, 2w, 2w + 1)
 
-        # allocate space for the overall attention matrix where the chunks are combined. The last dimension
+        # combine the chunks into the overall attention matrix with a single copy. The last dimension
         # has (w * 2 + 1) columns. The first (w) columns are the w lower triangles (attention from a word to
         # w previous words). The following column is attention score from each word to itself, then
         # followed by w columns for the upper triangle.
-
-        diagonal_attn = diagonal_chunk_attn.new_empty((bsz * num_heads, chunks_count + 1, w, w * 2 + 1))
+        diagonal_attn = torch.cat(
+            [
+                # the lower triangle
+                diagonal_chunk_attn[:, : chunks_count + 1, w - 1 : -1, w + 1 :],
+                # the main diagonal and the upper triangle
+                diagonal_chunk_attn[:, 1:, :w, : w + 1],
+            ],
+            dim=-1,
+        )
         # (batch x head, chunk_count + 1, w, 2w + 1)
 
-        # copy parts from diagonal_chunk_attn into the compined matrix of attentions
-        # - copying the main diagonal and the upper triangle
-        diagonal_attn[:, :-1, :, w:] = diagonal_chunk_attn[:, :, :w, : w + 1]
-        diagonal_attn[:, -1, :, w:] = diagonal_chunk_attn[:, -1, w:, : w + 1]
-        # - copying the lower triangle
-        diagonal_attn[:, 1:, :, :w] = diagonal_chunk_attn[:, :, -(w + 1) : -1, w + 1 :]
-        diagonal_attn[:, 0, 1:w, 1:w] = diagonal_chunk_attn[:, 0, : w - 1, 1 - w :]
-
         # separate bsz and num_heads dimensions again
         diagonal_attn = diagonal_attn.view(bsz, num_heads, seqlen, 2 * w + 1)
         # (batch, head, time, 2w + 1)
@@ -526,7 +806,6 @@ class RelPositionMultiHeadAttentionLongformer(RelPositionMultiHeadAttention):
             output (torch.Tensor): (batch, time, head, size)
         """
         bsz, num_heads, seqlen, head_dim = v.size()
-        chunks_count = seqlen // w - 1
         # group bsz and num_heads dimensions into one, then chunk seqlen into chunks of size 2w
         chunk_prob = prob.reshape(bsz * num_heads, seqlen // w, w, 2 * w + 1)
         # (batch x head, chunks_count + 1, w, 2w + 1)
@@ -540,10 +819,7 @@ class RelPositionMultiHeadAttentionLongformer(RelPositionMultiHeadAttention):
         # (batch x head, time + 2w, size)
 
         # chunk padded_v into chunks of size 3w and an overlap of size w
-        chunk_v_size = (bsz * num_heads, chunks_count + 1, 3 * w, head_dim)
-        chunk_v_stride = padded_v.stride()
-        chunk_v_stride = chunk_v_stride[0], w * chunk_v_stride[1], chunk_v_stride[1], chunk_v_stride[2]
-        chunk_v = padded_v.as_strided(size=chunk_v_size, stride=chunk_v_stride)
+        chunk_v = self._sliding_windows(padded_v, dim=1, size=3 * w, step=w)
         # (batch x head, chunks_count + 1, 3w, size)
 
         skewed_prob = self._skew2(chunk_prob, padding_value=0)
@@ -577,26 +853,36 @@ class PositionalEncoding(torch.nn.Module):
         else:
             self.dropout_emb = None
 
+        # frequencies are computed once and reused by every call of extend_pe
+        # not registered as a buffer on purpose, casting the module to half precision would ruin the encodings
+        self.div_term = torch.exp(
+            torch.arange(0, self.d_model, 2, dtype=torch.float32) * -(math.log(10000.0) / self.d_model)
+        )
+
+    @torch.no_grad()
     def create_pe(self, positions):
+        """Build the positional encodings for the given 1D tensor of positions."""
         pos_length = positions.size(0)
-        pe = torch.zeros(pos_length, self.d_model, device=positions.device)
-        div_term = torch.exp(
-            torch.arange(0, self.d_model, 2, dtype=torch.float32, device=positions.device)
-            * -(math.log(10000.0) / self.d_model)
-        )
-        pe[:, 0::2] = torch.sin(positions * div_term)
-        pe[:, 1::2] = torch.cos(positions * div_term)
+        if self.div_term.device != positions.device:
+            self.div_term = self.div_term.to(positions.device)
+        angles = torch.outer(positions, self.div_term)  # (pos_length, d_model // 2)
+        # interleave sin and cos in a single contiguous tensor instead of two strided writes into a zero tensor
+        pe = torch.stack((torch.sin(angles), torch.cos(angles)), dim=-1).view(pos_length, self.d_model)
         pe = pe.unsqueeze(0)
         if hasattr(self, 'pe'):
-            self.pe = pe
+            # keep the dtype of the current encodings, e.g. when the module was cast to half precision
+            self.pe = pe.to(self.pe.dtype)
         else:
             self.register_buffer('pe', pe, persistent=False)
 
     def extend_pe(self, length, device):
         """Reset and extend the positional encodings if needed."""
-        if hasattr(self, 'pe') and self.pe.size(1) >= length:
-            return
-        positions = torch.arange(0, length, dtype=torch.float32, device=device).unsqueeze(1)
+        if hasattr(self, 'pe'):
+            if self.pe.size(1) >= length:
+                return
+            # grow at least twice, a slowly increasing input length rebuilds the encodings only a few times
+            length = max(length, 2 * self.pe.size(1))
+        positions = torch.arange(0, length, dtype=torch.float32, device=device)
         self.create_pe(positions=positions)
 
     def forward(self, x: torch.Tensor):
@@ -630,11 +916,14 @@ class RelPositionalEncoding(PositionalEncoding):
     def extend_pe(self, length, device):
         """Reset and extend the positional encodings if needed."""
         needed_size = 2 * length - 1
-        if hasattr(self, 'pe') and self.pe.size(1) >= needed_size:
-            return
+        if hasattr(self, 'pe'):
+            if self.pe.size(1) >= needed_size:
+                return
+            # grow at least twice, a slowly increasing input length rebuilds the encodings only a few times
+            length = max(length, 2 * ((self.pe.size(1) + 1) // 2))
         # positions would be from negative numbers to positive
         # positive positions would be used for left positions and negative for right positions
-        positions = torch.arange(length - 1, -length, -1, dtype=torch.float32, device=device).unsqueeze(1)
+        positions = torch.arange(length - 1, -length, -1, dtype=torch.float32, device=device)
         self.create_pe(positions=positions)
 
     def forward(self, x, cache_len=0):
@@ -686,9 +975,7 @@ class LocalAttRelPositionalEncoding(PositionalEncoding):
         if hasattr(self, 'pe'):
             return
 
-        positions = torch.arange(
-            self.left_context, -self.right_context - 1, -1, dtype=torch.float32, device=device
-        ).unsqueeze(1)
+        positions = torch.arange(self.left_context, -self.right_context - 1, -1, dtype=torch.float32, device=device)
         self.create_pe(positions=positions)
 
     def forward(self, x, cache_len=0):
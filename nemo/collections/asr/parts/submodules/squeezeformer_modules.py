@@ -69,6 +69,7 @@ class SqueezeformerLayer(torch.nn.Module, AdapterModuleMixin, AccessMixin):
         dropout_att (float): dropout probabilities for attention distributions
         adaptive_scale (bool): Whether to scale the inputs to each component by affine `scale` and `bias` layer.
             Or use a fixed scale=1 and bias=0.
+        use_torch_compile (bool): whether to compile the attention layer with torch.compile when it is available
     """
 
     def __init__(
@@ -84,6 +85,7 @@ class SqueezeformerLayer(torch.nn.Module, AdapterModuleMixin, AccessMixin):
         pos_bias_u=None,
         pos_bias_v=None,
         adaptive_scale: bool = True,
+        use_torch_compile: bool = False,
     ):
         super().__init__()
 
@@ -108,10 +110,17 @@ class SqueezeformerLayer(torch.nn.Module, AdapterModuleMixin, AccessMixin):
         self.norm_self_att = LayerNorm(d_model)
         if self_attention_model == 'rel_pos':
             self.self_attn = RelPositionMultiHeadAttention(
-                n_head=n_heads, n_feat=d_model, dropout_rate=dropout_att, pos_bias_u=pos_bias_u, pos_bias_v=pos_bias_v
+                n_head=n_heads,
+                n_feat=d_model,
+                dropout_rate=dropout_att,
+                pos_bias_u=pos_bias_u,
+                pos_bias_v=pos_bias_v,
+                use_torch_compile=use_torch_compile,
             )
         elif self_attention_model == 'abs_pos':
-            self.self_attn = MultiHeadAttention(n_head=n_heads, n_feat=d_model, dropout_rate=dropout_att)
+            self.self_attn = MultiHeadAttention(
+                n_head=n_heads, n_feat=d_model, dropout_rate=dropout_att, use_torch_compile=use_torch_compile
+            )
         else:
             raise ValueError(
                 f"'{self_attention_model}' is not not a valid value for 'self_attention_model', "
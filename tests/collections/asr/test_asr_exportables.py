@@ -25,6 +25,7 @@ from nemo.collections.asr.models import (
     EncDecRNNTModel,
     EncDecSpeakerLabelModel,
 )
+from nemo.collections.asr.parts.submodules.multi_head_attention import HAVE_SDPA
 from nemo.collections.asr.parts.utils import asr_module_utils
 from nemo.collections.common.parts.adapter_modules import LinearAdapterConfig
 from nemo.core.utils import numba_utils
@@ -108,6 +109,40 @@ class TestExportable:
                 output=filename, input_example=tuple([input_example, input_example_length]), check_trace=True,
             )
 
+    @pytest.mark.unit
+    @pytest.mark.parametrize(
+        'conformer_local_attn_model',
+        [
+            pytest.param(
+                True,
+                marks=pytest.mark.skipif(not HAVE_SDPA, reason="scaled_dot_product_attention requires PyTorch 2.0"),
+            ),
+            False,
+        ],
+        indirect=True,
+    )
+    def test_ConformerModel_local_attn_export_to_onnx(self, conformer_local_attn_model):
+        model = conformer_local_attn_model.eval()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'conf_local_attn.onnx')
+            input_example = torch.randn(4, model.encoder._feat_in, 777)
+            input_example_length = torch.full(size=(input_example.shape[0],), fill_value=777)
+            model.export(output=filename, input_example=tuple([input_example, input_example_length]), check_trace=True)
+            onnx_model = onnx.load(filename)
+            onnx.checker.check_model(onnx_model, full_check=True)  # throws when failed
+            assert onnx_model.graph.input[0].name == 'audio_signal'
+            assert onnx_model.graph.output[0].name == 'logprobs'
+
+            # the exported graph has to stay valid for lengths other than the traced one
+            ort = pytest.importorskip('onnxruntime')
+            session = ort.InferenceSession(filename, providers=['CPUExecutionProvider'])
+            audio_signal = torch.randn(2, model.encoder._feat_in, 555)
+            length = torch.tensor([555, 400])
+            with torch.no_grad():
+                ref = model.forward_for_export(audio_signal, length)
+            out = session.run(None, {'audio_signal': audio_signal.numpy(), 'length': length.numpy()})[0]
+            assert torch.allclose(torch.from_numpy(out), ref, atol=1e-4)
+
     @pytest.mark.run_only_on('GPU')
     @pytest.mark.unit
     def test_SqueezeformerModel_export_to_onnx(self, squeezeformer_model):
@@ -630,6 +665,48 @@ def conformer_model():
     return conformer_model
 
 
+@pytest.fixture()
+def conformer_local_attn_model(request):
+    preprocessor = {'cls': 'nemo.collections.asr.modules.AudioToMelSpectrogramPreprocessor', 'params': dict({})}
+    encoder = {
+        'cls': 'nemo.collections.asr.modules.ConformerEncoder',
+        'params': {
+            'feat_in': 80,
+            'feat_out': -1,
+            'n_layers': 2,
+            'd_model': 256,
+            'subsampling': 'striding',
+            'subsampling_factor': 4,
+            'subsampling_conv_channels': 512,
+            'ff_expansion_factor': 4,
+            'self_attention_model': 'rel_pos_local_attn',
+            'n_heads': 8,
+            'att_context_size': [16, 16],
+            'xscaling': True,
+            'untie_biases': True,
+            'pos_emb_max_len': 500,
+            'conv_kernel_size': 31,
+            'dropout': 0.1,
+            'dropout_pre_encoder': 0.1,
+            'dropout_emb': 0.0,
+            'dropout_att': 0.1,
+            # the parametrized tests select the fused or the chunked local attention
+            'use_fused_attention': getattr(request, 'param', True),
+        },
+    }
+
+    decoder = {
+        'cls': 'nemo.collections.asr.modules.ConvASRDecoder',
+        'params': {'feat_in': 256, 'num_classes': 1024, 'vocabulary': list(chr(i % 28) for i in range(0, 1024))},
+    }
+
+    modelConfig = DictConfig(
+        {'preprocessor': DictConfig(preprocessor), 'encoder': DictConfig(encoder), 'decoder': DictConfig(decoder)}
+    )
+    conformer_model = EncDecCTCModel(cfg=modelConfig)
+    return conformer_model
+
+
 @pytest.fixture()
 def squeezeformer_model():
     preprocessor = {'cls': 'nemo.collections.asr.modules.AudioToMelSpectrogramPreprocessor', 'params': dict({})}
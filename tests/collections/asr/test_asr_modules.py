@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
+
 import pytest
 import torch
 from omegaconf import OmegaConf
 
 from nemo.collections.asr import modules
+from nemo.collections.asr.modules.transformer.transformer_modules import FixedPositionalEncoding
 from nemo.collections.asr.parts.utils.rnnt_utils import Hypothesis
 from nemo.core.utils import numba_utils
 from nemo.core.utils.numba_utils import __NUMBA_MINIMUM_VERSION__
@@ -357,3 +360,22 @@ class TestASRModulesBasicTests:
 
         # assert vocab size
         assert jointnet.num_classes_with_blank == vocab_size + 1
+
+    @pytest.mark.unit
+    def test_FixedPositionalEncoding(self):
+        hidden_size, max_sequence_length = 64, 100
+        # the encodings built by writing the sines and the cosines into the strided columns of a zero tensor
+        position = torch.arange(0.0, 2 * max_sequence_length).unsqueeze(1)
+        div_term = torch.exp(-math.log(10000.0) / hidden_size * torch.arange(0.0, hidden_size, 2))
+        ref = torch.zeros(2 * max_sequence_length, hidden_size)
+        ref[:, 0::2] = torch.sin(position * div_term)
+        ref[:, 1::2] = torch.cos(position * div_term)
+        ref.div_(math.sqrt(hidden_size))
+
+        pos_enc = FixedPositionalEncoding(hidden_size=hidden_size, max_sequence_length=max_sequence_length)
+        assert torch.allclose(pos_enc.pos_enc, ref[:max_sequence_length], atol=1e-6)
+
+        # positions beyond the maximum length rebuild the encodings just for this batch
+        position_ids = torch.arange(2 * max_sequence_length).unsqueeze(0)
+        assert torch.allclose(pos_enc(position_ids)[0], ref, atol=1e-6)
+        assert pos_enc.pos_enc.shape == (max_sequence_length, hidden_size)
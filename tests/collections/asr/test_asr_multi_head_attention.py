@@ -0,0 +1,530 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+
+import pytest
+import torch
+
+from nemo.collections.asr.parts.submodules.multi_head_attention import (
+    HAVE_MODULE_COMPILE,
+    HAVE_SDPA,
+    LocalAttRelPositionalEncoding,
+    MultiHeadAttention,
+    PositionalEncoding,
+    RelPositionalEncoding,
+    RelPositionMultiHeadAttention,
+    RelPositionMultiHeadAttentionLongformer,
+)
+
+
+def _make_pad_mask(lengths, max_len):
+    """Returns a (batch, time, time) attention mask with True at padded positions."""
+    valid = torch.arange(max_len)[None, :] < lengths[:, None]
+    return ~(valid.unsqueeze(1) & valid.unsqueeze(2))
+
+
+def _reference_mha(mha, query, key, value, mask):
+    """Explicit softmax attention used as the reference for the fused implementations."""
+    q, k, v = mha.forward_qkv(query, key, value)
+    scores = torch.matmul(q, k.transpose(-2, -1)) / mha.s_d_k
+    mask = mask.unsqueeze(1)
+    scores = scores.masked_fill(mask, -10000.0)
+    attn = torch.softmax(scores, dim=-1).masked_fill(mask, 0.0)
+    x = torch.matmul(attn, v).transpose(1, 2).reshape(query.size(0), -1, mha.h * mha.d_k)
+    return mha.linear_out(x)
+
+
+def _reference_rel_pos_scores(mha, query, key, value, pos_emb):
+    """Explicit Transformer-XL attention scores used as the reference for the fused implementations."""
+    q, k, v = mha.forward_qkv(query, key, value)
+    q = q.transpose(1, 2)
+    p = mha.linear_pos(pos_emb).view(pos_emb.size(0), -1, mha.h, mha.d_k).transpose(1, 2)
+    matrix_ac = torch.matmul((q + mha.pos_bias_u).transpose(1, 2), k.transpose(-2, -1))
+    matrix_bd = torch.matmul((q + mha.pos_bias_v).transpose(1, 2), p.transpose(-2, -1))
+    b, h, qlen, pos_len = matrix_bd.size()
+    matrix_bd = torch.nn.functional.pad(matrix_bd, pad=(1, 0)).view(b, h, -1, qlen)
+    matrix_bd = matrix_bd[:, :, 1:].view(b, h, qlen, pos_len)
+    matrix_bd = matrix_bd[:, :, :, : matrix_ac.size(-1)]
+    return (matrix_ac + matrix_bd) / mha.s_d_k, v
+
+
+def _reference_rel_pos_mha(mha, query, key, value, mask, pos_emb):
+    scores, v = _reference_rel_pos_scores(mha, query, key, value, pos_emb)
+    mask = mask.unsqueeze(1)
+    scores = scores.masked_fill(mask, -10000.0)
+    attn = torch.softmax(scores, dim=-1).masked_fill(mask, 0.0)
+    x = torch.matmul(attn, v).transpose(1, 2).reshape(query.size(0), -1, mha.h * mha.d_k)
+    return mha.linear_out(x)
+
+
+def _reference_local_attn_mha(mha, x, pad_mask, pos_emb):
+    """Dense Transformer-XL attention restricted to the attention context, the reference of local attention."""
+    left_context, right_context = mha.att_context_size
+    n_batch, T, _ = x.size()
+    q, k, v = mha.forward_qkv(x, x, x)
+    p = mha.linear_pos(pos_emb).view(pos_emb.size(0), -1, mha.h, mha.d_k).transpose(1, 2)
+    matrix_ac = torch.matmul(q + mha.pos_bias_u.unsqueeze(1), k.transpose(-2, -1))
+    matrix_bd = torch.matmul(q + mha.pos_bias_v.unsqueeze(1), p.transpose(-2, -1))
+    # the positional embeddings go from the distance left_context down to -right_context
+    offsets = torch.arange(T)[None, :] - torch.arange(T)[:, None]
+    index = (offsets + left_context).clamp(0, left_context + right_context)
+    matrix_bd = torch.gather(matrix_bd, 3, index.expand(n_batch, mha.h, T, T))
+    scores = (matrix_ac + matrix_bd) / mha.s_d_k
+    outside_context = (offsets < -left_context) | (offsets > right_context)
+    scores = scores.masked_fill(outside_context | pad_mask[:, None, None, :], -10000.0)
+    attn = torch.softmax(scores, dim=-1).masked_fill(pad_mask[:, None, :, None], 0.0)
+    x = torch.matmul(attn, v).transpose(1, 2).reshape(n_batch, -1, mha.h * mha.d_k)
+    return mha.linear_out(x)
+
+
+class TestMultiHeadAttention:
+    @pytest.mark.unit
+    def test_forward_matches_reference(self):
+        torch.manual_seed(0)
+        mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0).eval()
+        x = torch.randn(3, 17, 32)
+        mask = _make_pad_mask(torch.tensor([17, 11, 5]), 17)
+
+        with torch.no_grad():
+            out = mha(query=x, key=x, value=x, mask=mask)
+            ref = _reference_mha(mha, x, x, x, mask)
+
+        assert out.shape == (3, 17, 32)
+        assert torch.allclose(out, ref, atol=1e-5)
+
+    @pytest.mark.unit
+    def test_forward_attention_matches_reference(self):
+        torch.manual_seed(0)
+        mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0).eval()
+        x = torch.randn(3, 17, 32)
+        mask = _make_pad_mask(torch.tensor([17, 11, 5]), 17)
+
+        with torch.no_grad():
+            q, k, v = mha.forward_qkv(x, x, x)
+            scores = torch.matmul(q, k.transpose(-2, -1)) / mha.s_d_k
+            out = mha.forward_attention(v, scores, mask)
+            ref = _reference_mha(mha, x, x, x, mask)
+
+        assert torch.allclose(out, ref, atol=1e-5)
+
+    @pytest.mark.unit
+    def test_forward_qkv_packed_projection(self):
+        torch.manual_seed(0)
+        mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0)
+        x = torch.randn(3, 17, 32)
+
+        with torch.no_grad():
+            # self-attention uses the packed projection, copies of the input take the split projections
+            q, k, v = mha.forward_qkv(x, x, x)
+            ref_q, ref_k, ref_v = mha.forward_qkv(x, x.clone(), x.clone())
+
+        assert torch.allclose(q, ref_q, atol=1e-6)
+        assert torch.allclose(k, ref_k, atol=1e-6)
+        assert torch.allclose(v, ref_v, atol=1e-6)
+
+    @pytest.mark.unit
+    def test_packed_projection_cache(self):
+        torch.manual_seed(0)
+        mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0)
+        x = torch.randn(3, 17, 32)
+
+        with torch.no_grad():
+            weight, bias = mha._get_packed_qkv()
+            assert mha._get_packed_qkv()[0] is weight
+
+            # updates of a projection, in place or by loading a state dict, rebuild the packed weights
+            mha.linear_k.weight.mul_(2.0)
+            assert torch.equal(mha._get_packed_qkv()[0][32:64], mha.linear_k.weight)
+            mha.load_state_dict(MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0).state_dict())
+            q, k, v = mha.forward_qkv(x, x, x)
+            ref_q, ref_k, ref_v = mha.forward_qkv(x, x.clone(), x.clone())
+
+        assert torch.allclose(q, ref_q, atol=1e-6)
+        assert torch.allclose(k, ref_k, atol=1e-6)
+        assert torch.allclose(v, ref_v, atol=1e-6)
+
+    @pytest.mark.unit
+    def test_packed_projection_gradients(self):
+        mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0)
+        x = torch.randn(3, 17, 32)
+
+        q, k, v = mha.forward_qkv(x, x, x)
+        (q.sum() + 2 * k.sum() + 3 * v.sum()).backward()
+
+        # the projections stay separate parameters, which receive the gradients of the packed GEMM
+        assert [name for name, _ in mha.named_parameters()][:6] == [
+            'linear_q.weight',
+            'linear_q.bias',
+            'linear_k.weight',
+            'linear_k.bias',
+            'linear_v.weight',
+            'linear_v.bias',
+        ]
+        assert torch.allclose(mha.linear_k.bias.grad, torch.full((32,), 2.0 * 3 * 17))
+        assert mha._packed_qkv is None
+
+    @pytest.mark.unit
+    def test_update_cache(self):
+        mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0, max_cache_len=6)
+        mha._cache_id = 1
+        mha.cache_drop_size = 2
+        x = torch.randn(3, 5, 32)
+        cache = torch.randn(2, 3, 6, 32)
+        cache_next = torch.zeros_like(cache)
+
+        key, value, query = mha.update_cache(key=x, value=x, query=x, cache=cache, cache_next=cache_next)
+
+        assert torch.equal(key, torch.cat([cache[1], x], dim=1))
+        assert value is key and query is x
+        assert torch.equal(cache_next[1], torch.cat([cache[1, :, 3:], x[:, :3]], dim=1))
+        assert torch.equal(cache_next[0], torch.zeros_like(cache[0]))
+
+    @pytest.mark.unit
+    @pytest.mark.skipif(
+        torch.backends.quantized.engine == 'none', reason="quantized kernels are not available on this platform"
+    )
+    def test_quantize_projections(self):
+        torch.manual_seed(0)
+        mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0)
+        x = torch.randn(3, 17, 32)
+        mask = _make_pad_mask(torch.tensor([17, 11, 5]), 17)
+
+        with pytest.raises(RuntimeError):
+            mha.quantize_projections()
+
+        mha = mha.eval()
+        with torch.no_grad():
+            ref = mha(query=x, key=x, value=x, mask=mask)
+            mha.quantize_projections()
+            out = mha(query=x, key=x, value=x, mask=mask)
+
+        assert mha.quantized_projections
+        assert not isinstance(mha.linear_q, torch.nn.Linear)
+        assert out.shape == ref.shape
+        assert torch.allclose(out, ref, atol=5e-2)
+
+    @pytest.mark.unit
+    @pytest.mark.skipif(
+        torch.backends.quantized.engine == 'none', reason="quantized kernels are not available on this platform"
+    )
+    def test_quantize_projections_with_cache(self):
+        torch.manual_seed(0)
+        mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0).eval()
+        query = torch.randn(3, 5, 32)
+        # keys and values of the streaming cache are the same tensor, which differs from the query
+        key = torch.cat([torch.randn(3, 6, 32), query], dim=1)
+
+        with torch.no_grad():
+            ref_q, ref_k, ref_v = mha.forward_qkv(query, key, key)
+            mha.quantize_projections()
+            q, k, v = mha.forward_qkv(query, key, key)
+
+        assert q.shape == ref_q.shape and k.shape == ref_k.shape and v.shape == ref_v.shape
+        assert torch.allclose(q, ref_q, atol=5e-2)
+        assert torch.allclose(k, ref_k, atol=5e-2)
+        assert torch.allclose(v, ref_v, atol=5e-2)
+
+    @pytest.mark.unit
+    @pytest.mark.skipif(not HAVE_MODULE_COMPILE, reason="nn.Module.compile requires PyTorch 2.2")
+    def test_torch_compile_keeps_state_dict(self):
+        mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0)
+        compiled_mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0, use_torch_compile=True)
+
+        assert compiled_mha.use_torch_compile
+        assert compiled_mha.state_dict().keys() == mha.state_dict().keys()
+        compiled_mha.load_state_dict(mha.state_dict())
+
+
+class TestOnnxExportFallback:
+    @pytest.mark.unit
+    @pytest.mark.parametrize('attention_model', ['abs_pos', 'rel_pos'])
+    def test_explicit_attention_during_export(self, attention_model, monkeypatch):
+        torch.manual_seed(0)
+        x = torch.randn(3, 17, 32)
+        mask = _make_pad_mask(torch.tensor([17, 11, 5]), 17)
+        if attention_model == 'abs_pos':
+            mha = MultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0).eval()
+            inputs = dict(mask=mask)
+        else:
+            mha = RelPositionMultiHeadAttention(
+                n_head=4, n_feat=32, dropout_rate=0.0, pos_bias_u=None, pos_bias_v=None
+            ).eval()
+            pos_enc = RelPositionalEncoding(d_model=32, dropout_rate=0.0)
+            pos_enc.extend_pe(length=17, device=torch.device('cpu'))
+            inputs = dict(mask=mask, pos_emb=pos_enc(x)[1])
+
+        with torch.no_grad():
+            ref = mha(query=x, key=x, value=x, **inputs)
+
+            def _fail(*args, **kwargs):
+                raise AssertionError("the fused kernel must not be exported")
+
+            # the fused kernel is not used while the module is exported
+            monkeypatch.setattr(torch.onnx, 'is_in_onnx_export', lambda: True)
+            monkeypatch.setattr(torch.nn.functional, 'scaled_dot_product_attention', _fail, raising=False)
+            out = mha(query=x, key=x, value=x, **inputs)
+
+        assert torch.allclose(out, ref, atol=1e-5)
+
+
+class TestRelPositionMultiHeadAttention:
+    @pytest.mark.unit
+    def test_forward_matches_reference(self):
+        torch.manual_seed(0)
+        mha = RelPositionMultiHeadAttention(n_head=4, n_feat=32, dropout_rate=0.0, pos_bias_u=None, pos_bias_v=None)
+        mha = mha.eval()
+        torch.nn.init.normal_(mha.pos_bias_u)
+        torch.nn.init.normal_(mha.pos_bias_v)
+        pos_enc = RelPositionalEncoding(d_model=32, dropout_rate=0.0)
+        pos_enc.extend_pe(length=17, device=torch.device('cpu'))
+
+        x = torch.randn(3, 17, 32)
+        mask = _make_pad_mask(torch.tensor([17, 11, 5]), 17)
+
+        with torch.no_grad():
+            x, pos_emb = pos_enc(x)
+            out = mha(query=x, key=x, value=x, mask=mask, pos_emb=pos_emb)
+            ref = _reference_rel_pos_mha(mha, x, x, x, mask, pos_emb)
+
+        assert out.shape == (3, 17, 32)
+        assert torch.allclose(out, ref, atol=1e-5)
+
+    @pytest.mark.unit
+    def test_rel_shift_padded(self):
+        mha = RelPositionMultiHeadAttention(n_head=2, n_feat=8, dropout_rate=0.0, pos_bias_u=None, pos_bias_v=None)
+        x = torch.randn(2, 2, 5, 9)
+        padded = torch.nn.functional.pad(x, pad=(1, 0))
+
+        assert torch.equal(mha.rel_shift(padded, padded=True), mha.rel_shift(x))
+
+
+class TestRelPositionMultiHeadAttentionLongformer:
+    @pytest.mark.unit
+    @pytest.mark.parametrize(
+        'use_fused_attention',
+        [
+            pytest.param(
+                True,
+                marks=pytest.mark.skipif(not HAVE_SDPA, reason="scaled_dot_product_attention requires PyTorch 2.0"),
+            ),
+            False,
+        ],
+    )
+    @pytest.mark.parametrize(
+        'att_context_size,max_len', [([4, 4], 16), ([4, 4], 19), ([2, 5], 13), ([5, 2], 23), ([1, 3], 7)]
+    )
+    def test_forward_matches_reference(self, use_fused_attention, att_context_size, max_len):
+        torch.manual_seed(0)
+        mha = RelPositionMultiHeadAttentionLongformer(
+            n_head=4,
+            n_feat=32,
+            dropout_rate=0.0,
+            pos_bias_u=None,
+            pos_bias_v=None,
+            att_context_size=att_context_size,
+            use_fused_attention=use_fused_attention,
+        )
+        mha = mha.eval()
+        torch.nn.init.normal_(mha.pos_bias_u)
+        torch.nn.init.normal_(mha.pos_bias_v)
+        pos_enc = LocalAttRelPositionalEncoding(att_context_size=att_context_size, d_model=32, dropout_rate=0.0)
+        pos_enc.extend_pe(length=max_len, device=torch.device('cpu'))
+
+        x = torch.randn(3, max_len, 32)
+        lengths = torch.tensor([max_len, max_len - 4, 3])
+        pad_mask = torch.arange(max_len)[None, :] >= lengths[:, None]
+
+        with torch.no_grad():
+            x, pos_emb = pos_enc(x)
+            out = mha(query=x, key=x, value=x, pad_mask=pad_mask, pos_emb=pos_emb)
+            ref = _reference_local_attn_mha(mha, x, pad_mask, pos_emb)
+
+        assert out.shape == (3, max_len, 32)
+        assert torch.allclose(out, ref, atol=1e-5)
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('w,seqlen', [(1, 2), (1, 6), (2, 4), (2, 12), (3, 18)])
+    def test_sliding_chunks_matmul_qk(self, w, seqlen):
+        torch.manual_seed(0)
+        mha = RelPositionMultiHeadAttentionLongformer(
+            n_head=2, n_feat=8, dropout_rate=0.0, pos_bias_u=None, pos_bias_v=None, att_context_size=[w, w]
+        )
+        q = torch.randn(3, 2, seqlen, 4)
+        k = torch.randn(3, 2, seqlen, 4)
+
+        out = mha.sliding_chunks_matmul_qk(q, k, w, padding_value=0.0)
+
+        # column j of query t is the score of the key at time t - w + j, keys outside of the sequence are -inf
+        keys = torch.arange(seqlen)[:, None] - w + torch.arange(2 * w + 1)[None, :]
+        scores = torch.matmul(q, k.transpose(-2, -1))
+        ref = torch.gather(scores, 3, keys.clamp(0, seqlen - 1).expand(3, 2, seqlen, 2 * w + 1))
+        ref = ref.masked_fill((keys < 0) | (keys >= seqlen), -float('inf'))
+
+        assert out.shape == (3, 2, seqlen, 2 * w + 1)
+        assert torch.allclose(out, ref, atol=1e-5)
+
+    @pytest.mark.unit
+    @pytest.mark.skipif(not HAVE_SDPA, reason="scaled_dot_product_attention requires PyTorch 2.0")
+    @pytest.mark.parametrize('att_context_size', [[4, 4], [2, 3], [3, 1]])
+    def test_fused_attention_matches_chunked(self, att_context_size):
+        torch.manual_seed(0)
+        mha = RelPositionMultiHeadAttentionLongformer(
+            n_head=4, n_feat=32, dropout_rate=0.0, pos_bias_u=None, pos_bias_v=None, att_context_size=att_context_size
+        )
+        mha = mha.eval()
+        torch.nn.init.normal_(mha.pos_bias_u)
+        torch.nn.init.normal_(mha.pos_bias_v)
+        pos_enc = LocalAttRelPositionalEncoding(att_context_size=att_context_size, d_model=32, dropout_rate=0.0)
+        pos_enc.extend_pe(length=19, device=torch.device('cpu'))
+
+        x = torch.randn(3, 19, 32)
+        pad_mask = torch.arange(19)[None, :] >= torch.tensor([19, 12, 5])[:, None]
+
+        with torch.no_grad():
+            x, pos_emb = pos_enc(x)
+            mha.use_fused_attention = False
+            ref = mha(query=x, key=x, value=x, pad_mask=pad_mask, pos_emb=pos_emb)
+            mha.use_fused_attention = True
+            out = mha(query=x, key=x, value=x, pad_mask=pad_mask, pos_emb=pos_emb)
+
+        assert out.shape == (3, 19, 32)
+        assert torch.allclose(out, ref, atol=1e-5)
+
+
+class TestHalfPrecisionAutocast:
+    @pytest.mark.unit
+    @pytest.mark.skipif(not HAVE_SDPA, reason="scaled_dot_product_attention requires PyTorch 2.0")
+    @pytest.mark.parametrize('attention_model', ['rel_pos', 'rel_pos_local_attn'])
+    def test_bf16_autocast_matches_fp32(self, attention_model, monkeypatch):
+        torch.manual_seed(0)
+        x = torch.randn(3, 19, 32)
+        lengths = torch.tensor([19, 12, 5])
+        if attention_model == 'rel_pos':
+            mha = RelPositionMultiHeadAttention(
+                n_head=4, n_feat=32, dropout_rate=0.0, pos_bias_u=None, pos_bias_v=None
+            )
+            pos_enc = RelPositionalEncoding(d_model=32, dropout_rate=0.0)
+            pos_enc.extend_pe(length=19, device=torch.device('cpu'))
+            inputs = dict(mask=_make_pad_mask(lengths, 19), pos_emb=pos_enc(x)[1])
+        else:
+            mha = RelPositionMultiHeadAttentionLongformer(
+                n_head=4, n_feat=32, dropout_rate=0.0, pos_bias_u=None, pos_bias_v=None, att_context_size=[4, 3]
+            )
+            pos_enc = LocalAttRelPositionalEncoding(att_context_size=[4, 3], d_model=32, dropout_rate=0.0)
+            pos_enc.extend_pe(length=19, device=torch.device('cpu'))
+            inputs = dict(pad_mask=torch.arange(19)[None, :] >= lengths[:, None], pos_emb=pos_enc(x)[1])
+        mha = mha.eval()
+        torch.nn.init.normal_(mha.pos_bias_u)
+        torch.nn.init.normal_(mha.pos_bias_v)
+
+        sdpa = torch.nn.functional.scaled_dot_product_attention
+        kernel_dtypes = []
+
+        def _sdpa(q, k, v, attn_mask=None, **kwargs):
+            kernel_dtypes.append((q.dtype, k.dtype, v.dtype, attn_mask.dtype))
+            return sdpa(q, k, v, attn_mask=attn_mask, **kwargs)
+
+        monkeypatch.setattr(torch.nn.functional, 'scaled_dot_product_attention', _sdpa)
+
+        with torch.no_grad():
+            ref = mha(query=x, key=x, value=x, **inputs)
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                out = mha(query=x, key=x, value=x, **inputs)
+
+        # the fused kernel runs in fp32 without autocast and in bf16 with it, the bias follows the query
+        assert kernel_dtypes == [(torch.float32,) * 4, (torch.bfloat16,) * 4]
+        assert torch.allclose(out.float(), ref, atol=5e-2)
+
+
+class TestTorchCompile:
+    @pytest.mark.unit
+    @pytest.mark.skipif(not HAVE_MODULE_COMPILE, reason="nn.Module.compile requires PyTorch 2.2")
+    @pytest.mark.parametrize('attention_model', ['abs_pos', 'rel_pos', 'rel_pos_local_attn'])
+    def test_torch_compile_matches_eager(self, attention_model):
+        torch.manual_seed(0)
+        x = torch.randn(3, 19, 32)
+        lengths = torch.tensor([19, 12, 5])
+        kwargs = dict(n_head=4, n_feat=32, dropout_rate=0.0)
+        if attention_model == 'abs_pos':
+            module_cls = MultiHeadAttention
+            inputs = dict(mask=_make_pad_mask(lengths, 19))
+        elif attention_model == 'rel_pos':
+            module_cls = RelPositionMultiHeadAttention
+            kwargs.update(pos_bias_u=None, pos_bias_v=None)
+            pos_enc = RelPositionalEncoding(d_model=32, dropout_rate=0.0)
+            pos_enc.extend_pe(length=19, device=torch.device('cpu'))
+            inputs = dict(mask=_make_pad_mask(lengths, 19), pos_emb=pos_enc(x)[1])
+        else:
+            module_cls = RelPositionMultiHeadAttentionLongformer
+            kwargs.update(pos_bias_u=None, pos_bias_v=None, att_context_size=[4, 3])
+            pos_enc = LocalAttRelPositionalEncoding(att_context_size=[4, 3], d_model=32, dropout_rate=0.0)
+            pos_enc.extend_pe(length=19, device=torch.device('cpu'))
+            inputs = dict(pad_mask=torch.arange(19)[None, :] >= lengths[:, None], pos_emb=pos_enc(x)[1])
+
+        mha = module_cls(**kwargs).eval()
+        for name, param in mha.named_parameters():
+            if name.startswith('pos_bias'):
+                torch.nn.init.normal_(param)
+        compiled_mha = module_cls(**kwargs, use_torch_compile=True).eval()
+        compiled_mha.load_state_dict(mha.state_dict())
+
+        with torch.no_grad():
+            ref = mha(query=x, key=x, value=x, **inputs)
+            out = compiled_mha(query=x, key=x, value=x, **inputs)
+
+        assert torch.allclose(out, ref, atol=1e-5)
+
+
+class TestPositionalEncoding:
+    @pytest.mark.unit
+    def test_create_pe(self):
+        d_model = 16
+        pos_enc = PositionalEncoding(d_model=d_model, dropout_rate=0.0)
+        pos_enc.extend_pe(length=50, device=torch.device('cpu'))
+
+        positions = torch.arange(0, 50, dtype=torch.float32).unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, d_model, 2, dtype=torch.float32) * -(math.log(10000.0) / d_model))
+        ref = torch.zeros(50, d_model)
+        ref[:, 0::2] = torch.sin(positions * div_term)
+        ref[:, 1::2] = torch.cos(positions * div_term)
+
+        assert pos_enc.pe.shape == (1, 50, d_model)
+        assert torch.allclose(pos_enc.pe[0], ref)
+
+    @pytest.mark.unit
+    def test_extend_pe_grows_geometrically(self):
+        pos_enc = PositionalEncoding(d_model=16, dropout_rate=0.0)
+        pos_enc.extend_pe(length=50, device=torch.device('cpu'))
+        pos_enc.extend_pe(length=51, device=torch.device('cpu'))
+        assert pos_enc.pe.shape == (1, 100, 16)
+
+        rel_pos_enc = RelPositionalEncoding(d_model=16, dropout_rate=0.0)
+        rel_pos_enc.extend_pe(length=50, device=torch.device('cpu'))
+        rel_pos_enc.extend_pe(length=51, device=torch.device('cpu'))
+        assert rel_pos_enc.pe.shape == (1, 199, 16)
+
+        x = torch.randn(2, 51, 16)
+        _, pos_emb = rel_pos_enc(x)
+        ref = RelPositionalEncoding(d_model=16, dropout_rate=0.0)
+        ref.extend_pe(length=51, device=torch.device('cpu'))
+        _, ref_pos_emb = ref(x)
+        assert torch.allclose(pos_emb, ref_pos_emb, atol=1e-5)
+
+    @pytest.mark.unit
+    def test_extend_pe_keeps_dtype(self):
+        pos_enc = PositionalEncoding(d_model=16, dropout_rate=0.0)
+        pos_enc.extend_pe(length=10, device=torch.device('cpu'))
+        pos_enc = pos_enc.half()
+        pos_enc.extend_pe(length=30, device=torch.device('cpu'))
+        assert pos_enc.pe.dtype == torch.float16
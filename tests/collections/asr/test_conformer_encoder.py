@@ -15,6 +15,7 @@ import pytest
 import torch
 
 from nemo.collections.asr.modules.conformer_encoder import ConformerEncoder
+from nemo.collections.asr.parts.submodules.multi_head_attention import HAVE_MODULE_COMPILE
 
 
 class TestStochasticDepth:
@@ -115,3 +116,50 @@ class TestStochasticDepth:
             if not torch.allclose(outputs[i], outputs[0]):
                 num_diff += 1
         assert num_diff == 0
+
+
+class TestTorchCompile:
+    """Testing that torch.compile can be enabled from the encoder config."""
+
+    @pytest.mark.unit
+    @pytest.mark.skipif(not HAVE_MODULE_COMPILE, reason="nn.Module.compile requires PyTorch 2.2")
+    @pytest.mark.parametrize('self_attention_model', ['rel_pos', 'rel_pos_local_attn', 'abs_pos'])
+    def test_use_torch_compile(self, self_attention_model):
+        torch.manual_seed(0)
+        kwargs = dict(
+            feat_in=10,
+            n_layers=2,
+            d_model=8,
+            feat_out=8,
+            self_attention_model=self_attention_model,
+            att_context_size=[4, 4],
+        )
+        model = ConformerEncoder(**kwargs).eval()
+        compiled_model = ConformerEncoder(**kwargs, use_torch_compile=True).eval()
+        compiled_model.load_state_dict(model.state_dict())
+        assert all(layer.self_attn.use_torch_compile for layer in compiled_model.layers)
+
+        random_input = torch.rand((2, 10, 40))
+        random_length = torch.tensor([40, 27], dtype=torch.int64)
+        with torch.no_grad():
+            ref = model(audio_signal=random_input, length=random_length)[0]
+            out = compiled_model(audio_signal=random_input, length=random_length)[0]
+
+        assert torch.allclose(out, ref, atol=1e-5)
+
+
+class TestFusedLocalAttention:
+    """Testing that the fused local attention can be selected from the encoder config."""
+
+    @pytest.mark.unit
+    def test_use_fused_attention(self):
+        model = ConformerEncoder(
+            feat_in=10,
+            n_layers=2,
+            d_model=8,
+            feat_out=8,
+            self_attention_model='rel_pos_local_attn',
+            att_context_size=[4, 4],
+            use_fused_attention=False,
+        )
+        assert not any(layer.self_attn.use_fused_attention for layer in model.layers)
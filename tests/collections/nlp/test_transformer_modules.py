@@ -0,0 +1,43 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+
+import pytest
+import torch
+
+from nemo.collections.nlp.modules.common.transformer.transformer_modules import FixedPositionalEncoding
+
+
+class TestFixedPositionalEncoding:
+    @pytest.mark.unit
+    @pytest.mark.parametrize('hidden_size', [2, 64, 512])
+    def test_matches_strided_construction(self, hidden_size):
+        max_sequence_length = 100
+        # the encodings built by writing the sines and the cosines into the strided columns of a zero tensor
+        position = torch.arange(0.0, 2 * max_sequence_length).unsqueeze(1)
+        div_term = torch.exp(-math.log(10000.0) / hidden_size * torch.arange(0.0, hidden_size, 2))
+        ref = torch.zeros(2 * max_sequence_length, hidden_size)
+        ref[:, 0::2] = torch.sin(position * div_term)
+        ref[:, 1::2] = torch.cos(position * div_term)
+        ref.div_(math.sqrt(hidden_size))
+
+        pos_enc = FixedPositionalEncoding(hidden_size=hidden_size, max_sequence_length=max_sequence_length)
+        assert pos_enc.pos_enc.is_contiguous()
+        assert torch.allclose(pos_enc.pos_enc, ref[:max_sequence_length], atol=1e-6)
+
+        # positions beyond the maximum length rebuild the encodings just for this batch
+        position_ids = torch.arange(2 * max_sequence_length).unsqueeze(0)
+        assert torch.allclose(pos_enc(position_ids)[0], ref, atol=1e-6)
+        assert pos_enc.pos_enc.shape == (max_sequence_length, hidden_size)